@@ -1,30 +1,139 @@
 import asyncio
 import websockets
-import json
-import pandas as pd
+import orjson
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
 import time
 import os
+import gzip
+import random
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import repeat
 from datetime import datetime, timezone, timedelta
 
+try:
+    import uvloop  # libuv-based event loop; not available on Windows
+except ImportError:
+    uvloop = None
+
+
+ROW_SCHEMA = pa.schema([
+    ('timestamp', pa.int64()),
+    ('price', pa.float64()),
+    ('quantity', pa.float64()),
+    ('side', pa.string()),
+    ('level', pa.int8()),
+    ('update_id', pa.int64()),
+])
+
+FILE_EXTENSIONS = {'csv': '.csv.gz', 'csv_zstd': '.csv.zst', 'parquet': '.parquet'}
+
+# Compression levels are chosen for write speed: flushes happen every minute on a live feed
+GZIP_LEVEL = 1
+ZSTD_LEVEL = 3
+PARQUET_ZSTD_LEVEL = 1
+
+# Written by hand: Arrow's CSV writer quotes header names, and the pinned pyarrow cannot turn that off
+CSV_HEADER = (','.join(ROW_SCHEMA.names) + '\n').encode('ascii')
+
+# CSV writer settings are fixed, so build them once, with a conversion batch large enough
+# to format a whole flush in one pass
+_CSV_WRITE_OPTIONS = pacsv.WriteOptions(include_header=False, batch_size=65_536, quoting_style='none')
+_ZSTD_CODEC = pa.Codec('zstd', compression_level=ZSTD_LEVEL)  # Only used from the writer thread
+
+DEPTH_LEVELS = 10  # Number of price levels kept per side
+
+# Constant column values per side, sliced to the number of levels in a message
+_BID_SIDES = ('bid',) * DEPTH_LEVELS
+_ASK_SIDES = ('ask',) * DEPTH_LEVELS
+_LEVELS = tuple(range(1, DEPTH_LEVELS + 1))
+
+MAX_RECV_BATCH = 100  # Upper bound on queued messages drained per receive step
+
+# Reconnect delay: doubles after each failed attempt, plus up to RECONNECT_JITTER seconds of random jitter
+RECONNECT_DELAY_MIN = 0.5
+RECONNECT_DELAY_MAX = 30
+RECONNECT_JITTER = 0.5
+
+
+def _to_record_batch(columns):
+    """
+    Builds an Arrow record batch with ROW_SCHEMA from the six buffered column lists.
+    """
+    return pa.record_batch(
+        [pa.array(column, type=field.type) for column, field in zip(columns, ROW_SCHEMA)],
+        schema=ROW_SCHEMA
+    )
+
+
+def _format_levels(levels):
+    """
+    Formats the top price levels of one book side as a Price/Quantity table.
+    """
+    # One (n, 2) float64 array instead of a DataFrame; reshape keeps an empty side two columns wide
+    arr = np.asarray(levels[:DEPTH_LEVELS], dtype=np.float64).reshape(-1, 2)
+    lines = [f"{'Price':>14} {'Quantity':>14}"]
+    lines.extend(f"{price:>14} {qty:>14}" for price, qty in arr.tolist())
+    return '\n'.join(lines)
+
+
+def _queued_frames(websocket):
+    """
+    Returns how many frames the connection has read off the socket but not yet returned from recv().
+    recv() hands these out without suspending. Relies on the websockets asyncio client's message
+    assembler and returns 0 when it is not available.
+    """
+    frames = getattr(getattr(websocket, 'recv_messages', None), 'frames', None)
+    return len(frames) if frames is not None else 0
+
 
 class OrderBookDataCollector:
     """
-    Collects order book data from Binance WebSocket, buffers it, and periodically writes to compressed CSV files.
-    Handles file rollover at midnight UTC and supports live printing of order book snapshots.
+    Collects order book data from Binance WebSocket, buffers it, and periodically writes to compressed CSV
+    (gzip or zstd) or Parquet files. Handles file rollover at midnight UTC and supports live printing of order book snapshots.
     """
-    def __init__(self, url, symbol):
+    def __init__(self, url, symbol, file_format='csv', max_buffer_rows=50_000, verbose=False):
         """
-        Initialize the collector with WebSocket URL and trading symbol.
+        Initialize the collector with WebSocket URL, trading symbol and output format
+        ('csv' for gzip, 'csv_zstd' or 'parquet').
+        The buffer is flushed early once it holds max_buffer_rows rows.
+        With verbose set, the periodic status line also prints the top 10 bids and asks.
         """
+        if file_format not in FILE_EXTENSIONS:
+            raise ValueError(f"Unsupported file format: {file_format!r}")
         self.url = url
         self.symbol = symbol.upper()
+        self.file_format = file_format
+        self.max_buffer_rows = max_buffer_rows
+        self.verbose = verbose
+        self._printed_book = None  # Order book snapshot whose tables are in _book_text
+        self._book_text = None  # Formatted bid/ask tables for verbose output
         self.order_book = None  # Latest order book snapshot
         self.last_update = None  # Timestamp of last update (string)
         self.running = True  # Control flag for async loops
-        self.buffer = []  # Buffer for order book rows
-        self.last_flush = time.time()  # Last time buffer was flushed
+        # Column buffers for order book rows (one list per output column)
+        self.ts_buf = []
+        self.price_buf = []
+        self.qty_buf = []
+        self.side_buf = []
+        self.level_buf = []
+        self.uid_buf = []
+        self.last_flush = time.monotonic()  # Last time buffer was flushed (monotonic clock)
         self.current_date = self.get_current_date()  # Current date string (YYYY-MM-DD)
+        self._last_second = 0  # Wall-clock second the cached time strings were computed for
+        self._cached_date = self.current_date  # UTC date as of _last_second
+        self._last_print = time.monotonic()  # Last time the status line was printed (monotonic clock)
+        self._write_failed = False  # Last write failed; its rows are back in the buffer awaiting retry
         self.last_rollover = time.time()  # Last time file rollover occurred
+        self._current_filepath = None  # Output path for current_date, resolved on first flush
+        self._header_path = None  # CSV file known to start with a header (writer thread only)
+        self._pq_writer = None  # Open Parquet writer for the current day (parquet format only)
+        self._pq_path = None  # Path the Parquet writer is writing to
+        # Single writer thread: file writes run off the event loop and stay in submission order
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='orderbook-writer')
 
 
     def get_current_date(self):
@@ -36,143 +145,360 @@ class OrderBookDataCollector:
 
     def get_filepath(self):
         """
-        Returns the file path for the current day's compressed CSV file.
+        Returns the file path for the current day's output file, with the extension from FILE_EXTENSIONS.
         Creates the directory if it does not exist.
         """
-        date_str = self.get_current_date()
+        date_str = self.current_date
         dir_path = os.path.join('data', self.symbol)
         os.makedirs(dir_path, exist_ok=True)
-        return os.path.join(dir_path, f'{date_str}.csv.gz')
+        return os.path.join(dir_path, f'{date_str}{FILE_EXTENSIONS[self.file_format]}')
 
 
     def buffer_snapshot(self, data):
         """
-        Extracts top 10 bids and asks from the order book update and appends them to the buffer.
-        Each row includes timestamp, price, quantity, side, level, and update_id.
-        """
-        timestamp = data.get('E')
-        update_id = data.get('u')
-        bids = data.get('b', [])
-        asks = data.get('a', [])
-        # Top 10 bids
-        for i, (price, qty) in enumerate(bids[:10], 1):
-            self.buffer.append({
-                'timestamp': timestamp,
-                'price': price,
-                'quantity': qty,
-                'side': 'bid',
-                'level': i,
-                'update_id': update_id
-            })
-        # Top 10 asks
-        for i, (price, qty) in enumerate(asks[:10], 1):
-            self.buffer.append({
-                'timestamp': timestamp,
-                'price': price,
-                'quantity': qty,
-                'side': 'ask',
-                'level': i,
-                'update_id': update_id
-            })
-
-
-    def flush_buffer(self):
-        """
-        Writes the buffered order book rows to the current day's compressed CSV file.
-        Appends to the file and writes the header if the file is new.
-        Clears the buffer after writing.
-        """
-        if not self.buffer:
+        Extracts top 10 bids and asks from the order book update and appends them to the column buffers.
+        Each row includes timestamp, price, quantity, side, level, and update_id; price and quantity are
+        stored as floats. Messages missing any of the E, u, b or a fields are ignored.
+        """
+        self.buffer_snapshot_batch((data,))
+
+
+    def buffer_snapshot_batch(self, messages):
+        """
+        Buffers a sequence of order book updates in arrival order, as buffer_snapshot does for one.
+        A message with malformed contents is skipped on its own; the rest of the batch is still buffered.
+        Returns the last message that was buffered, or None if every message was skipped.
+        """
+        accepted = None
+        # Bind the bound methods once per batch instead of looking them up for each message
+        ts_extend, price_extend, qty_extend = self.ts_buf.extend, self.price_buf.extend, self.qty_buf.extend
+        side_extend, level_extend, uid_extend = self.side_buf.extend, self.level_buf.extend, self.uid_buf.extend
+        for data in messages:
+            # Validate and convert both sides before extending any column, so a bad message
+            # cannot leave partial rows behind
+            try:
+                # depthUpdate messages always carry these keys; anything else is skipped
+                timestamp, update_id, bids, asks = int(data['E']), int(data['u']), data['b'], data['a']
+                parsed = []
+                for sides, levels in ((_BID_SIDES, bids[:DEPTH_LEVELS]), (_ASK_SIDES, asks[:DEPTH_LEVELS])):
+                    n = len(levels)
+                    if not n:
+                        continue
+                    # Transpose [[price, qty], ...] into price and quantity columns in one C-level pass,
+                    # parsing Binance's decimal strings to floats
+                    prices, qtys = zip(*levels)
+                    parsed.append((sides, n, tuple(map(float, prices)), tuple(map(float, qtys))))
+            except KeyError:
+                continue
+            except (TypeError, ValueError) as e:
+                print(f"Skipping malformed message: {e}")
+                continue
+            for sides, n, prices, qtys in parsed:
+                ts_extend(repeat(timestamp, n))
+                price_extend(prices)
+                qty_extend(qtys)
+                side_extend(sides[:n])
+                level_extend(_LEVELS[:n])
+                uid_extend(repeat(update_id, n))
+            accepted = data
+        return accepted
+
+
+    def _ensure_filepath(self):
+        """
+        Returns the cached output path for the current day.
+        The path is resolved once per day and reset by rollover_file.
+        """
+        if self._current_filepath is None:
+            self._current_filepath = self.get_filepath()
+        return self._current_filepath
+
+
+    def _take_buffer(self):
+        """
+        Hands over the current column buffers and replaces them with empty ones.
+        """
+        columns = (self.ts_buf, self.price_buf, self.qty_buf, self.side_buf, self.level_buf, self.uid_buf)
+        self.ts_buf, self.price_buf, self.qty_buf = [], [], []
+        self.side_buf, self.level_buf, self.uid_buf = [], [], []
+        return columns
+
+
+    def flush_buffer(self, wait=True):
+        """
+        Writes the buffered order book rows to the current day's output file on the writer thread.
+        CSV files are appended to and get a header when new; Parquet rows are written as a new row group.
+        Blocks until the write is done unless wait is False.
+        If the write fails, its rows are put back in front of the buffer so the next flush retries them.
+        """
+        if not self.ts_buf:
+            return
+        columns = self._take_buffer()
+        future = self._executor.submit(self._write_columns, self._ensure_filepath(), columns)
+        self.last_flush = time.monotonic()
+        if wait:
+            try:
+                future.result()
+            except Exception:
+                self._restore_buffer(columns)
+                raise
+            self._write_failed = False
+        else:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                loop = None
+            future.add_done_callback(partial(self._on_background_write_done, loop, columns))
+
+
+    def _on_background_write_done(self, loop, columns, future):
+        """
+        Handles the result of a background write. Runs on the writer thread.
+        On failure the rows are handed back to the event loop thread, which owns the buffers.
+        """
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is None:
+            self._write_failed = False
+            return
+        if loop is None or loop.is_closed():
+            print(f"Error writing buffer, {len(columns[0])} rows lost: {error}")
             return
-        df = pd.DataFrame(self.buffer)
-        filepath = self.get_filepath()
-        write_header = not os.path.exists(filepath)
-        df.to_csv(filepath, mode='a', header=write_header, index=False, compression='gzip')
-        print(f'Flushed {len(self.buffer)} rows to {filepath}')
-        self.buffer = []
-        self.last_flush = time.time()
+        print(f"Error writing buffer, keeping {len(columns[0])} rows for the next flush: {error}")
+        loop.call_soon_threadsafe(self._restore_buffer, columns)
+
+
+    def _restore_buffer(self, columns):
+        """
+        Puts the rows of a failed write back in front of the rows buffered since.
+        """
+        live = (self.ts_buf, self.price_buf, self.qty_buf, self.side_buf, self.level_buf, self.uid_buf)
+        for restored, rows in zip(columns, live):
+            restored.extend(rows)
+        self.ts_buf, self.price_buf, self.qty_buf, self.side_buf, self.level_buf, self.uid_buf = columns
+        self._write_failed = True
+
+
+    def _report_write_error(self, future):
+        """
+        Prints the error of a background write that nobody waits on.
+        """
+        if not future.cancelled() and future.exception() is not None:
+            print(f"Error writing buffer: {future.exception()}")
+
+
+    def _write_columns(self, filepath, columns):
+        """
+        Writes a set of column lists to filepath in the configured format. Runs on the writer thread.
+        """
+        if self.file_format == 'parquet':
+            filepath = self._write_parquet(filepath, columns)
+        else:
+            self._write_csv(filepath, columns, self.file_format == 'csv_zstd')
+        print(f'Flushed {len(columns[0])} rows to {filepath}')
 
 
-    def rollover_file(self):
+    def _write_csv(self, filepath, columns, zstd=False):
         """
-        Flushes the buffer and updates the current date for file rollover (e.g., at midnight UTC).
+        Appends the rows to a gzip (or zstd) compressed CSV file, preceded by the header if the file is new.
+        The header is only recorded as written once the write succeeds, so a failed first write is retried
+        with its header.
         """
-        self.flush_buffer()
+        # Only checks the filesystem until the first successful write to each file
+        write_header = filepath != self._header_path and (
+            not os.path.exists(filepath) or os.path.getsize(filepath) == 0
+        )
+        # Arrow's C++ CSV writer formats the rows; compression is done separately so the level can be chosen
+        out = pa.BufferOutputStream()
+        if write_header:
+            out.write(CSV_HEADER)
+        pacsv.write_csv(_to_record_batch(columns), out, write_options=_CSV_WRITE_OPTIONS)
+        # Each flush appends a new gzip member / zstd frame; readers see one continuous stream
+        if zstd:
+            with open(filepath, 'ab') as f:
+                f.write(_ZSTD_CODEC.compress(out.getvalue(), asbytes=True))
+        else:
+            # mtime=0 keeps the member headers free of timestamps, so identical rows give identical bytes
+            with gzip.GzipFile(filepath, 'ab', compresslevel=GZIP_LEVEL, mtime=0) as f:
+                f.write(out.getvalue())
+        self._header_path = filepath
+
+
+    def _write_parquet(self, filepath, columns):
+        """
+        Writes the rows as one row group to the day's Parquet file and returns the path written to.
+        The writer is opened lazily and kept open until rollover or close.
+        """
+        if self._pq_writer is None:
+            # A Parquet file cannot be appended to once closed, so a restart on the
+            # same day starts a new part file instead of truncating the existing one
+            base, ext = os.path.splitext(filepath)
+            part = 1
+            while os.path.exists(filepath):
+                filepath = f'{base}.{part}{ext}'
+                part += 1
+            self._pq_writer = pq.ParquetWriter(
+                filepath, ROW_SCHEMA, compression='zstd', compression_level=PARQUET_ZSTD_LEVEL, use_dictionary=['side']
+            )
+            self._pq_path = filepath
+        batch = _to_record_batch(columns)
+        self._pq_writer.write_batch(batch)
+        return self._pq_path
+
+
+    def close_writer(self):
+        """
+        Closes the open Parquet writer, if any, so the file footer is written. Runs on the writer thread.
+        """
+        if self._pq_writer is not None:
+            self._pq_writer.close()
+            self._pq_writer = None
+            self._pq_path = None
+
+
+    def close(self):
+        """
+        Flushes any buffered rows, closes open output files and stops the writer thread.
+        """
+        self.flush_buffer(wait=False)
+        self._executor.submit(self.close_writer).add_done_callback(self._report_write_error)
+        self._executor.shutdown(wait=True)
+
+
+    def rollover_file(self, wait=True):
+        """
+        Flushes the buffer, closes the current file and updates the current date for file rollover
+        (e.g., at midnight UTC). Blocks until the old file is closed unless wait is False.
+        """
+        self.flush_buffer(wait=False)
+        future = self._executor.submit(self.close_writer)
         self.current_date = self.get_current_date()
+        self._current_filepath = None
         print(f'Rollover: New file for date {self.current_date}')
         self.last_rollover = time.time()
+        if wait:
+            future.result()
+        else:
+            future.add_done_callback(self._report_write_error)
 
     async def receive_data(self):
         """
         Connects to the Binance WebSocket and receives order book updates.
-        Buffers each update, handles file rollover at midnight, and flushes buffer every 60 seconds.
+        Buffers each update (draining already queued messages as one batch), handles file rollover at midnight,
+        flushes buffer every 60 seconds or once it reaches max_buffer_rows, and prints a status line every
+        10 seconds. Malformed messages are skipped; lost connections are retried with exponential backoff.
         """
-        print("Connecting to Binance WebSocket...")
-        print("Connected!")
+        delay = RECONNECT_DELAY_MIN
         while self.running:
             try:
-                async with websockets.connect(self.url) as websocket:
+                print("Connecting to Binance WebSocket...")
+                # Depth frames are small, so skip permessage-deflate; pings detect silently dropped connections
+                async with websockets.connect(
+                    self.url, compression=None, max_size=2**20, ping_interval=20, ping_timeout=10
+                ) as websocket:
+                    print("Connected!")
                     while self.running:
                         try:
-                            message = await websocket.recv()
-                            data = json.loads(message)
-                            self.order_book = data
-                            self.last_update = time.strftime('%Y-%m-%d %H:%M:%S')
-                            self.buffer_snapshot(data)
+                            # Raw bytes: orjson validates UTF-8 while parsing, so skip the str decode
+                            messages = [await websocket.recv(decode=False)]
+                            # Drain messages that already arrived in one go; recv() returns them without suspending
+                            while _queued_frames(websocket) and len(messages) < MAX_RECV_BATCH:
+                                messages.append(await websocket.recv(decode=False))
+                            batch = []
+                            for message in messages:
+                                try:
+                                    batch.append(orjson.loads(message))
+                                except orjson.JSONDecodeError as e:
+                                    print(f"Skipping undecodable message: {e}")
+                            if not batch:
+                                continue
+                            # Only a message that was actually buffered becomes the displayed snapshot
+                            latest = self.buffer_snapshot_batch(batch)
+                            if latest is not None:
+                                self.order_book = latest
+                            # The connection delivers data, so the next reconnect starts from the shortest delay
+                            delay = RECONNECT_DELAY_MIN
+                            # Time strings only change once per second, so format them once per second
+                            now = time.time()
+                            sec = int(now)
+                            if sec != self._last_second:
+                                self._last_second = sec
+                                self.last_update = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now))
+                                self._cached_date = self.get_current_date()
                             # Rollover at midnight UTC
-                            new_date = self.get_current_date()
-                            if new_date != self.current_date:
-                                self.rollover_file()
-                            # Flush every 60 seconds
-                            if time.time() - self.last_flush > 60:
-                                self.flush_buffer()
+                            if self._cached_date != self.current_date:
+                                self.rollover_file(wait=False)
+                            # Flush every 60 seconds, or earlier if a burst fills the buffer
+                            mono = time.monotonic()
+                            # After a failed write only the interval retries, so a broken disk is not hit on every message
+                            full = len(self.ts_buf) >= self.max_buffer_rows and not self._write_failed
+                            if full or mono - self.last_flush > 60:
+                                self.flush_buffer(wait=False)
+                            # Status line every 10 seconds
+                            if mono - self._last_print > 10:
+                                self._last_print = mono
+                                self.print_data()
                         except asyncio.CancelledError:
                             print("receive_data cancelled.")
                             raise
+                        except websockets.ConnectionClosed:
+                            raise
                         except Exception as e:
+                            # Malformed messages are skipped where they are parsed; anything else reconnects
                             print(f"Error in receive_data inner loop: {e}")
-                            break
+                            raise
             except asyncio.CancelledError:
                 print("receive_data cancelled (outer).")
                 raise
-            except (websockets.ConnectionClosed, websockets.InvalidStatusCode, OSError) as e:
-                print(f"WebSocket connection lost: {e}. Reconnecting in 5 seconds...")
-                await asyncio.sleep(5)
+            except (websockets.ConnectionClosed, websockets.InvalidStatus, OSError) as e:
+                print(f"WebSocket connection lost: {e}.")
             except Exception as e:
                 print(f"Unexpected error in receive_data: {e}")
-                await asyncio.sleep(5)
+            # Every reconnect waits out the backoff; only a stop request skips it
+            if self.running:
+                wait = delay + random.random() * RECONNECT_JITTER
+                print(f"Reconnecting in {wait:.1f} seconds...")
+                await asyncio.sleep(wait)
+                delay = min(delay * 2, RECONNECT_DELAY_MAX)
 
 
-    async def print_data(self):
+    def print_data(self):
         """
-        Periodically prints the latest order book snapshot (every 10 seconds).
-        Only prints the last update time for brevity.
+        Prints the last update time. The latest order book snapshot is only printed in verbose mode;
+        its tables are formatted once per snapshot and reused while the snapshot is unchanged.
         """
-        while self.running:
-            if self.order_book:
-                bids = self.order_book.get("b")
-                asks = self.order_book.get("a")
-                if bids is not None and asks is not None:
-                    bids_df = pd.DataFrame(bids, columns=["Price", "Quantity"]).astype(float)
-                    asks_df = pd.DataFrame(asks, columns=["Price", "Quantity"]).astype(float)
-                    # Uncomment below for more detailed output
-                    # print("\n--- Order Book Snapshot ---")
-                    print(f"Last update: {self.last_update}")
-                    # print("Top 10 Bids:")
-                    # print(bids_df.head(10).to_string(index=False))
-                    # print("Top 10 Asks:")
-                    # print(asks_df.head(10).to_string(index=False))
-            await asyncio.sleep(10)
+        if self.order_book and self.last_update:
+            print(f"Last update: {self.last_update}")
+            if self.verbose:
+                if self.order_book is not self._printed_book:
+                    try:
+                        bids = self.order_book.get("b")
+                        asks = self.order_book.get("a")
+                        if bids is None or asks is None:
+                            return
+                        book_text = (
+                            f"Top {DEPTH_LEVELS} Bids:\n{_format_levels(bids)}\n"
+                            f"Top {DEPTH_LEVELS} Asks:\n{_format_levels(asks)}"
+                        )
+                    except (AttributeError, TypeError, ValueError) as e:
+                        # A display problem must never end the receive loop
+                        print(f"Could not format order book snapshot: {e}")
+                        return
+                    self._printed_book = self.order_book
+                    self._book_text = book_text
+                print(self._book_text)
 
 
     async def run(self):
         """
-        Runs the data receiver and printer concurrently.
+        Runs the data receiver, which also prints the periodic status line.
+        Buffered rows are flushed and files closed on exit.
         """
-        await asyncio.gather(
-            self.receive_data(),
-            self.print_data()
-        )
+        try:
+            await self.receive_data()
+        finally:
+            self.close()
 
 
 # Entry point for running the collector as a script
@@ -180,4 +506,7 @@ if __name__ == "__main__":
     symbol = "BTCUSDT"
     url = f"wss://fstream.binance.com/ws/{symbol.lower()}@depth20@100ms"
     collector = OrderBookDataCollector(url, symbol)
-    asyncio.run(collector.run())
\ No newline at end of file
+    if uvloop is not None:
+        uvloop.run(collector.run())
+    else:
+        asyncio.run(collector.run())
\ No newline at end of file
@@ -6,13 +6,17 @@ import time
 from datetime import datetime, timezone, timedelta
 
 # Third-party imports
+import json
 import pandas as pd
 import pytest
 import asyncio
+from collections import deque
+from types import SimpleNamespace
 from unittest.mock import AsyncMock, patch
 import websockets
 
 # Import the main class to be tested
+import main
 from main import OrderBookDataCollector
 
 
@@ -71,7 +75,7 @@ def test_buffer_snapshot_and_flush(tmp_path):
     data = make_fake_data(ts, 1)
     collector.buffer_snapshot(data)
     # Each snapshot should add 20 rows (10 bids + 10 asks)
-    assert len(collector.buffer) == 20
+    assert len(collector.ts_buf) == 20
     collector.flush_buffer()
     files = list((tmp_path / 'data' / symbol).glob('*.csv.gz'))
     assert len(files) == 1
@@ -82,6 +86,84 @@ def test_buffer_snapshot_and_flush(tmp_path):
         assert set(['timestamp','price','quantity','side','level','update_id']).issubset(df.columns)
 
 
+# Test that the column buffers stay aligned and keep bid/ask level order
+def test_buffer_columns_aligned(tmp_path):
+    symbol = "TESTCOIN"
+    os.chdir(tmp_path)
+    collector = OrderBookDataCollector(url="", symbol=symbol)
+    bids = [['100.5', '1.0'], ['100.4', '2.0']]
+    asks = [['100.6', '3.0']]
+    collector.buffer_snapshot(make_fake_data(1234567890, 1, bids=bids, asks=asks))
+    collector.flush_buffer()
+    files = list((tmp_path / 'data' / symbol).glob('*.csv.gz'))
+    with gzip.open(files[0], 'rt') as fin:
+        assert fin.readline() == 'timestamp,price,quantity,side,level,update_id\n'
+        assert fin.readline() == '1234567890,100.5,1,bid,1,6\n'
+    with gzip.open(files[0], 'rt') as fin:
+        df = pd.read_csv(fin)
+    assert list(df['side']) == ['bid', 'bid', 'ask']
+    assert list(df['level']) == [1, 2, 1]
+    assert list(df['price']) == [100.5, 100.4, 100.6]
+    assert list(df['quantity']) == [1.0, 2.0, 3.0]
+    assert (df['timestamp'] == 1234567890).all()
+    assert (df['update_id'] == 6).all()
+    # Buffers are emptied after a flush
+    assert len(collector.ts_buf) == 0
+
+
+# Test that a batch of updates is buffered in order and malformed messages are skipped
+def test_buffer_snapshot_batch(tmp_path):
+    os.chdir(tmp_path)
+    collector = OrderBookDataCollector(url="", symbol="TESTCOIN")
+    batch = [make_fake_data(1, 1), {'result': None, 'id': 1}, make_fake_data(2, 2)]
+    collector.buffer_snapshot_batch(batch)
+    assert len(collector.ts_buf) == 40
+    assert collector.ts_buf[0] == 1 and collector.ts_buf[-1] == 2
+    assert collector.price_buf[0] == 119000.0 and collector.qty_buf[10] == 2.0
+    assert len(collector.uid_buf) == len(collector.side_buf) == len(collector.price_buf) == 40
+
+
+# Test that a message with malformed contents is skipped without affecting the rest of its batch
+def test_buffer_snapshot_batch_skips_malformed(tmp_path):
+    os.chdir(tmp_path)
+    collector = OrderBookDataCollector(url="", symbol="TESTCOIN")
+    bad_price = make_fake_data(5, 5, asks=[['not a number', '1.0']])
+    bad_level = make_fake_data(6, 6, bids=[['100.0']])
+    batch = [make_fake_data(1, 1), bad_price, bad_level, ['not', 'a', 'dict'], make_fake_data(2, 2), make_fake_data(3, 3)]
+    collector.buffer_snapshot_batch(batch)
+    assert collector.ts_buf[::20] == [1, 2, 3]
+    assert len(collector.ts_buf) == len(collector.price_buf) == len(collector.uid_buf) == 60
+
+
+# Test that a failed first write of the day does not lose the header for later flushes
+def test_header_written_after_failed_first_write(tmp_path, monkeypatch):
+    symbol = "TESTCOIN"
+    os.chdir(tmp_path)
+    collector = OrderBookDataCollector(url="", symbol=symbol)
+    calls = {"count": 0}
+    real_gzip_file = gzip.GzipFile
+
+    def failing_once(*args, **kwargs):
+        calls["count"] += 1
+        if calls["count"] == 1:
+            raise OSError("disk full")
+        return real_gzip_file(*args, **kwargs)
+
+    monkeypatch.setattr(gzip, "GzipFile", failing_once)
+    collector.buffer_snapshot(make_fake_data(1234567890, 1))
+    with pytest.raises(OSError):
+        collector.flush_buffer()
+    # The failed rows stay buffered and are retried, ahead of newer rows
+    assert len(collector.ts_buf) == 20
+    collector.buffer_snapshot(make_fake_data(1234567891, 2))
+    collector.flush_buffer()
+    files = list((tmp_path / 'data' / symbol).glob('*.csv.gz'))
+    with gzip.open(files[0], 'rt') as fin:
+        df = pd.read_csv(fin)
+    assert list(df.columns) == ['timestamp','price','quantity','side','level','update_id']
+    assert list(df['timestamp'][::20]) == [1234567890, 1234567891]
+
+
 # Test that empty bids/asks do not add to the buffer or create files
 def test_empty_bids_asks(tmp_path):
     symbol = "TESTCOIN"
@@ -90,7 +172,7 @@ def test_empty_bids_asks(tmp_path):
     ts = 1234567890
     data = make_fake_data(ts, 1, bids=[], asks=[])
     collector.buffer_snapshot(data)
-    assert len(collector.buffer) == 0
+    assert len(collector.ts_buf) == 0
     collector.flush_buffer()
     files = list((tmp_path / 'data' / symbol).glob('*.csv.gz'))
     assert len(files) == 0
@@ -104,7 +186,11 @@ def test_missing_keys(tmp_path):
     ts = 1234567890
     data = {'E': ts, 'u': 1}  # Missing bids/asks
     collector.buffer_snapshot(data)
-    assert len(collector.buffer) == 0
+    assert len(collector.ts_buf) == 0
+    data = make_fake_data(ts, 1)
+    del data['E']  # Missing timestamp
+    collector.buffer_snapshot(data)
+    assert len(collector.ts_buf) == 0
     collector.flush_buffer()
     files = list((tmp_path / 'data' / symbol).glob('*.csv.gz'))
     assert len(files) == 0
@@ -129,6 +215,78 @@ def test_multiple_flushes(tmp_path):
         # Should have 40 rows (20 from each flush)
         assert len(df) == 40
 
+# Test that the parquet format writes one readable file per day and starts a new part when reopened
+def test_parquet_flush_and_rollover(tmp_path):
+    import pyarrow.parquet as pq
+    symbol = "TESTCOIN"
+    os.chdir(tmp_path)
+    collector = OrderBookDataCollector(url="", symbol=symbol, file_format='parquet')
+    collector.buffer_snapshot(make_fake_data(1234567890, 1))
+    collector.flush_buffer()
+    collector.buffer_snapshot(make_fake_data(1234567891, 2))
+    collector.flush_buffer()
+    collector.rollover_file()
+    files = list((tmp_path / 'data' / symbol).glob('*.parquet'))
+    assert len(files) == 1
+    table = pq.read_table(files[0])
+    assert table.num_rows == 40
+    assert table.column_names == ['timestamp','price','quantity','side','level','update_id']
+    assert table.column('price')[0].as_py() == 119000.0
+    # Reopening the same day must not truncate the existing file
+    collector.buffer_snapshot(make_fake_data(1234567892, 3))
+    collector.close()
+    files = sorted((tmp_path / 'data' / symbol).glob('*.parquet'))
+    assert len(files) == 2
+    assert sum(pq.read_table(f).num_rows for f in files) == 60
+
+
+# Test that the zstd CSV format appends readable frames and writes the header once
+def test_csv_zstd_multiple_flushes(tmp_path):
+    import pyarrow.csv as pacsv
+    symbol = "TESTCOIN"
+    os.chdir(tmp_path)
+    collector = OrderBookDataCollector(url="", symbol=symbol, file_format='csv_zstd')
+    collector.buffer_snapshot(make_fake_data(1234567890, 1))
+    collector.flush_buffer()
+    collector.buffer_snapshot(make_fake_data(1234567891, 2))
+    collector.flush_buffer()
+    files = list((tmp_path / 'data' / symbol).glob('*.csv.zst'))
+    assert len(files) == 1
+    table = pacsv.read_csv(files[0])
+    assert table.num_rows == 40
+    assert table.column_names == ['timestamp','price','quantity','side','level','update_id']
+
+
+def test_unsupported_file_format():
+    with pytest.raises(ValueError):
+        OrderBookDataCollector(url="", symbol="TESTCOIN", file_format='xlsx')
+
+
+# Test that verbose status output prints the top levels and reuses them while the snapshot is unchanged
+def test_print_data_verbose(capsys):
+    collector = OrderBookDataCollector(url="", symbol="TESTCOIN", verbose=True)
+    collector.order_book = make_fake_data(1234567890, 1)
+    collector.last_update = '2025-08-11 00:00:00'
+    collector.print_data()
+    out = capsys.readouterr().out
+    assert 'Last update: 2025-08-11 00:00:00' in out
+    assert 'Top 10 Bids:' in out and '119000.0' in out
+    assert 'Top 10 Asks:' in out and '120009.0' in out
+    book_text = collector._book_text
+    collector.print_data()
+    assert collector._book_text is book_text
+    assert capsys.readouterr().out == out
+
+
+def test_print_data_malformed_snapshot(capsys):
+    collector = OrderBookDataCollector(url="", symbol="TESTCOIN", verbose=True)
+    collector.last_update = '2025-08-11 00:00:00'
+    for book in (["not", "a", "dict"], {"b": [["1"]], "a": []}, {"b": [["1", "2", "3"], ["4", "5"]], "a": []}):
+        collector.order_book = book
+        collector.print_data()
+        assert 'Could not format order book snapshot' in capsys.readouterr().out
+
+
 @pytest.mark.asyncio
 async def test_reconnection_logic(monkeypatch):
     symbol = "TESTCOIN"
@@ -141,7 +299,7 @@ async def test_reconnection_logic(monkeypatch):
         def __init__(self):
             self.recv_count = 0
 
-        async def recv(self):
+        async def recv(self, decode=None):
             self.recv_count += 1
             if self.recv_count == 1:
                 return '{"b": [], "a": [], "E": 123, "u": 1}'
@@ -160,18 +318,293 @@ async def test_reconnection_logic(monkeypatch):
     monkeypatch.setattr(websockets, "connect", lambda *args, **kwargs: MockWebSocket())
 
     collector.running = True
-    task = asyncio.create_task(collector.receive_data())
-    try:
-        await asyncio.wait_for(asyncio.sleep(5.5), timeout=6)  # Add timeout
-    except asyncio.TimeoutError:
-        task.cancel()
-        raise AssertionError("Test timed out, likely due to stalled receive_data loop.")
-    collector.running = False
-    await asyncio.sleep(0.1)
-    task.cancel()
-    try:
-        await task
-    except asyncio.CancelledError:
-        pass
+    # The first retry waits at most RECONNECT_DELAY_MIN + RECONNECT_JITTER, then the second recv() exits
+    with pytest.raises(asyncio.CancelledError):
+        await asyncio.wait_for(collector.receive_data(), timeout=5)
+
+    assert connect_attempts["count"] == 2, "Reconnection did not occur as expected"
+
+
+@pytest.mark.asyncio
+async def test_reconnect_backoff(monkeypatch):
+    collector = OrderBookDataCollector("wss://test", "TESTCOIN")
+    # Eight failed attempts, one connection that delivers a message and is then lost, one more failure, then stop
+    attempts = ['fail'] * 8 + ['ok', 'fail', 'stop']
+    delays = []
+
+    class MockWebSocket:
+        def __init__(self):
+            self.messages = [json.dumps(make_fake_data(1234567890, 1)).encode()]
+
+        async def recv(self, decode=None):
+            if self.messages:
+                return self.messages.pop(0)
+            raise websockets.ConnectionClosed(None, None)
+
+        async def __aenter__(self):
+            attempt = attempts.pop(0)
+            if attempt == 'fail':
+                raise OSError("connection refused")
+            if attempt == 'stop':
+                raise asyncio.CancelledError()
+            return self
+
+        async def __aexit__(self, exc_type, exc, tb):
+            pass
+
+    async def fake_sleep(delay):
+        delays.append(delay)
+
+    monkeypatch.setattr(websockets, "connect", lambda *args, **kwargs: MockWebSocket())
+    monkeypatch.setattr(asyncio, "sleep", fake_sleep)
+    monkeypatch.setattr(main.random, "random", lambda: 0.0)
+
+    with pytest.raises(asyncio.CancelledError):
+        await collector.receive_data()
+    # Doubles per failure up to RECONNECT_DELAY_MAX, and starts over once a connection delivers data
+    assert delays == [0.5, 1, 2, 4, 8, 16, main.RECONNECT_DELAY_MAX, main.RECONNECT_DELAY_MAX, 0.5, 1]
+
+
+@pytest.mark.asyncio
+async def test_flush_on_max_buffer_rows(tmp_path, monkeypatch):
+    symbol = "TESTCOIN"
+    os.chdir(tmp_path)
+    collector = OrderBookDataCollector("wss://test", symbol, max_buffer_rows=40)
+    messages = [json.dumps(make_fake_data(1234567890 + i, i)).encode() for i in range(2)]
+
+    class MockWebSocket:
+        async def recv(self, decode=None):
+            if messages:
+                return messages.pop(0)
+            raise asyncio.CancelledError()
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, exc_type, exc, tb):
+            pass
+
+    monkeypatch.setattr(websockets, "connect", lambda *args, **kwargs: MockWebSocket())
+
+    with pytest.raises(asyncio.CancelledError):
+        await collector.receive_data()
+    # Wait for the background write to finish
+    collector.close()
+    # Two snapshots fill the 40-row buffer, which is flushed without waiting 60 seconds
+    files = list((tmp_path / 'data' / symbol).glob('*.csv.gz'))
+    assert len(files) == 1
+    with gzip.open(files[0], 'rt') as fin:
+        assert len(pd.read_csv(fin)) == 40
+    assert len(collector.ts_buf) == 0
+
+
+@pytest.mark.asyncio
+async def test_malformed_message_keeps_connection(tmp_path, monkeypatch):
+    os.chdir(tmp_path)
+    collector = OrderBookDataCollector("wss://test", "TESTCOIN")
+    messages = [b'not json', json.dumps(make_fake_data(1234567890, 1)).encode()]
+    connect_attempts = {"count": 0}
+
+    class MockWebSocket:
+        async def recv(self, decode=None):
+            if messages:
+                return messages.pop(0)
+            raise asyncio.CancelledError()
+
+        async def __aenter__(self):
+            connect_attempts["count"] += 1
+            return self
+
+        async def __aexit__(self, exc_type, exc, tb):
+            pass
+
+    monkeypatch.setattr(websockets, "connect", lambda *args, **kwargs: MockWebSocket())
+
+    with pytest.raises(asyncio.CancelledError):
+        await collector.receive_data()
+    # The bad message is skipped on the same connection and the next one is buffered
+    assert connect_attempts["count"] == 1
+    assert len(collector.ts_buf) == 20
+
+
+@pytest.mark.asyncio
+async def test_queued_messages_drained_in_batches(tmp_path, monkeypatch):
+    os.chdir(tmp_path)
+    monkeypatch.setattr(main, "MAX_RECV_BATCH", 3)
+    collector = OrderBookDataCollector("wss://test", "TESTCOIN")
+    batch_sizes = []
+    buffer_snapshot_batch = collector.buffer_snapshot_batch
+
+    def recording_batch(batch):
+        batch_sizes.append(len(batch))
+        buffer_snapshot_batch(batch)
+
+    collector.buffer_snapshot_batch = recording_batch
+
+    class MockWebSocket:
+        def __init__(self):
+            # Mirrors the websockets asyncio client: frames read off the socket but not yet returned
+            self.recv_messages = SimpleNamespace(frames=deque(
+                json.dumps(make_fake_data(1000 + i, i)).encode() for i in range(7)
+            ))
+
+        async def recv(self, decode=None):
+            if self.recv_messages.frames:
+                return self.recv_messages.frames.popleft()
+            raise asyncio.CancelledError()
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, exc_type, exc, tb):
+            pass
+
+    monkeypatch.setattr(websockets, "connect", lambda *args, **kwargs: MockWebSocket())
+
+    with pytest.raises(asyncio.CancelledError):
+        await collector.receive_data()
+    # Seven queued messages are drained in batches capped at MAX_RECV_BATCH, in arrival order
+    assert batch_sizes == [3, 3, 1]
+    assert collector.ts_buf[::20] == [1000 + i for i in range(7)]
+    assert len(collector.ts_buf) == 140
+
+
+@pytest.mark.asyncio
+async def test_queued_frames_on_real_connection():
+    # _queued_frames relies on a private attribute of the websockets asyncio client; check it still exists
+    async def handler(server_ws):
+        for i in range(3):
+            await server_ws.send(json.dumps(make_fake_data(i, i)))
+        await server_ws.wait_closed()
+
+    async with websockets.serve(handler, "localhost", 0) as server:
+        port = server.sockets[0].getsockname()[1]
+        async with websockets.connect(f"ws://localhost:{port}") as websocket:
+            first = await websocket.recv(decode=False)
+            for _ in range(50):
+                if main._queued_frames(websocket) == 2:
+                    break
+                await asyncio.sleep(0.01)
+            assert main._queued_frames(websocket) == 2
+            assert isinstance(first, bytes)
+
+
+@pytest.mark.asyncio
+async def test_failed_background_write_keeps_rows(tmp_path, monkeypatch):
+    symbol = "TESTCOIN"
+    os.chdir(tmp_path)
+    collector = OrderBookDataCollector("wss://test", symbol, max_buffer_rows=20)
+    messages = [json.dumps(make_fake_data(1234567890 + i, i)).encode() for i in range(2)]
+    calls = {"count": 0}
+    real_gzip_file = gzip.GzipFile
+
+    def failing_once(*args, **kwargs):
+        calls["count"] += 1
+        if calls["count"] == 1:
+            raise OSError("disk full")
+        return real_gzip_file(*args, **kwargs)
+
+    class MockWebSocket:
+        async def recv(self, decode=None):
+            # Yield to the loop so the failed write from the previous message is handed back
+            await asyncio.sleep(0.05)
+            if messages:
+                return messages.pop(0)
+            raise asyncio.CancelledError()
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, exc_type, exc, tb):
+            pass
+
+    monkeypatch.setattr(gzip, "GzipFile", failing_once)
+    monkeypatch.setattr(websockets, "connect", lambda *args, **kwargs: MockWebSocket())
+
+    with pytest.raises(asyncio.CancelledError):
+        await collector.receive_data()
+    # The first, failed flush is back in the buffer, and the full-buffer trigger waits for the interval
+    assert calls["count"] == 1
+    assert collector.ts_buf[::20] == [1234567890, 1234567891]
+    collector.close()
+    files = list((tmp_path / 'data' / symbol).glob('*.csv.gz'))
+    with gzip.open(files[0], 'rt') as fin:
+        df = pd.read_csv(fin)
+    assert list(df['timestamp'][::20]) == [1234567890, 1234567891]
+
+
+@pytest.mark.asyncio
+async def test_inner_error_reconnects_with_backoff(tmp_path, monkeypatch):
+    os.chdir(tmp_path)
+    collector = OrderBookDataCollector("wss://test", "TESTCOIN")
+    connect_attempts = {"count": 0}
+    delays = []
+
+    class MockWebSocket:
+        async def recv(self, decode=None):
+            return json.dumps(make_fake_data(1234567890, 1)).encode()
+
+        async def __aenter__(self):
+            connect_attempts["count"] += 1
+            if connect_attempts["count"] == 4:
+                raise asyncio.CancelledError()
+            return self
+
+        async def __aexit__(self, exc_type, exc, tb):
+            pass
+
+    def broken_ingest(batch):
+        raise RuntimeError("ingest failure")
+
+    async def fake_sleep(delay):
+        delays.append(delay)
+
+    collector.buffer_snapshot_batch = broken_ingest
+    monkeypatch.setattr(websockets, "connect", lambda *args, **kwargs: MockWebSocket())
+    monkeypatch.setattr(asyncio, "sleep", fake_sleep)
+    monkeypatch.setattr(main.random, "random", lambda: 0.0)
+
+    with pytest.raises(asyncio.CancelledError):
+        await collector.receive_data()
+    # A persistent error on a live connection waits out a growing delay before every reconnect
+    assert connect_attempts["count"] == 4
+    assert delays == [0.5, 1, 2]
+
+
+@pytest.mark.asyncio
+async def test_rejected_messages_not_displayed(tmp_path, monkeypatch, capsys):
+    os.chdir(tmp_path)
+    collector = OrderBookDataCollector("wss://test", "TESTCOIN", verbose=True)
+    good = make_fake_data(1234567890, 1)
+    connect_attempts = {"count": 0}
+
+    class MockWebSocket:
+        def __init__(self):
+            self.messages = [json.dumps(m).encode() for m in (good, [1, 2], {**good, "b": [["1"]]})]
+
+        async def recv(self, decode=None):
+            if self.messages:
+                return self.messages.pop(0)
+            raise asyncio.CancelledError()
+
+        async def __aenter__(self):
+            connect_attempts["count"] += 1
+            return self
+
+        async def __aexit__(self, exc_type, exc, tb):
+            pass
+
+    monkeypatch.setattr(websockets, "connect", lambda *args, **kwargs: MockWebSocket())
+    monkeypatch.setattr(main, "_queued_frames", lambda websocket: False)
+    # Force the status line on every batch
+    collector._last_print = collector.last_flush = 0
+    monkeypatch.setattr(main.time, "monotonic", iter(range(20, 10_000, 20)).__next__)
 
-    assert connect_attempts["count"] >= 2, "Reconnection did not occur as expected"
\ No newline at end of file
+    with pytest.raises(asyncio.CancelledError):
+        await collector.receive_data()
+    # Rejected messages neither replace the displayed snapshot nor drop the connection
+    assert connect_attempts["count"] == 1
+    assert collector.order_book == good
+    out = capsys.readouterr().out
+    assert 'Top 10 Bids:' in out
+    assert 'Could not format' not in out